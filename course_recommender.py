@@ -1,83 +1,591 @@
 import anthropic
+import asyncio
+import functools
+import hashlib
 import json
+import math
 import os
-from typing import List, Dict, Any, Optional
+import random
+import re
+import string
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Mapping, Optional, Tuple, Union
 import time
+import types
 import logging
 
+try:
+    import orjson
+    ORJSON = True
+except Exception:
+    ORJSON = False
+
+try:
+    import msgspec
+    MSGSPEC = True
+except Exception:
+    MSGSPEC = False
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DEPARTMENTS_DIR = "departments"
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+
+
+def _load_prompt_template(name: str) -> string.Template:
+    """Read a prompt template from the prompts directory, minus the file's trailing newline."""
+    with open(os.path.join(PROMPTS_DIR, name), 'r', encoding='utf-8') as f:
+        return string.Template(f.read().rstrip('\n'))
+
+
+# Stage 2 prompt: the per-department catalog and rules, then the student profile
+_COURSE_SELECT_TMPL = _load_prompt_template("course_select.tmpl")
+_COURSE_SELECT_STUDENT_TMPL = _load_prompt_template("course_select_student.tmpl")
+
+# orjson parses several times faster than the stdlib; both accept str or bytes, and
+# orjson.JSONDecodeError subclasses json.JSONDecodeError so error handling is unchanged
+_json_loads = orjson.loads if ORJSON else json.loads
+
+if MSGSPEC:
+    class Course(msgspec.Struct):
+        """A course as returned by Claude in stage 2; unknown fields are ignored."""
+        course_title: str
+        course_description: str = ""
+        department: str = ""
+        prerequisites: Optional[List[str]] = None
+
+        def __post_init__(self):
+            if self.prerequisites is None:
+                self.prerequisites = []
+
+    _DEPARTMENT_LIST_DECODER = msgspec.json.Decoder(List[Any])
+    # Courses are validated one at a time, so a single bad entry doesn't drop its siblings
+    _RAW_LIST_DECODER = msgspec.json.Decoder(List[msgspec.Raw])
+    _COURSE_DECODER = msgspec.json.Decoder(Course)
+
+
+def _decode_departments(raw: str) -> List[str]:
+    """Parse the stage 1 department array, keeping only its string entries so one bad entry doesn't drop the rest."""
+    departments = _DEPARTMENT_LIST_DECODER.decode(raw) if MSGSPEC else _json_loads(raw)
+    if not isinstance(departments, list):
+        raise ValueError(f"Expected a JSON array of department names, got {type(departments).__name__}")
+    return [dept for dept in departments if isinstance(dept, str)]
+
+
+def _decode_courses(raw: str) -> Any:
+    """
+    Parse the stage 2 course array.
+
+    With msgspec each entry is validated against Course and returned as a plain dict; entries
+    that don't fit (e.g. no course_title) are logged and skipped. A payload that isn't a JSON
+    array raises msgspec.DecodeError (a ValueError).
+    """
+    if not MSGSPEC:
+        return _json_loads(raw)
+
+    courses = []
+    for item in _RAW_LIST_DECODER.decode(raw):
+        try:
+            courses.append(msgspec.to_builtins(_COURSE_DECODER.decode(item)))
+        except msgspec.ValidationError as e:
+            logger.warning(f"Skipping invalid course entry {bytes(item)[:200]!r}: {str(e)}")
+    return courses
+
+# Compiled once; responses can be several kB and these run on every API call
+_JSON_ARRAY_RE = re.compile(r'\[.*?\]', re.DOTALL)
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def _extract_json_array(text: str) -> Optional[str]:
+    """
+    Return the first balanced top-level JSON array in text, or None if there isn't one.
+
+    Single O(n) scan that tracks string literals, so brackets inside course titles
+    or descriptions don't end the array early.
+    """
+    start_idx = text.find('[')
+    if start_idx == -1:
+        return None
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start_idx, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+            if depth == 0:
+                return text[start_idx:i + 1]
+    return None
+
+
+# Available departments with course counts. Shared, read-only, and identical for every request.
+_AVAILABLE_DEPARTMENTS: Mapping[str, int] = types.MappingProxyType({
+    "Aeronautics_and_Astronautics": 92,
+    "Anthropology": 67,
+    "Architecture": 116,
+    "Athletics,_Physical_Education_and_Recreation": 10,
+    "Biological_Engineering": 41,
+    "Biology": 85,
+    "Brain_and_Cognitive_Sciences": 99,
+    "Chemical_Engineering": 57,
+    "Chemistry": 43,
+    "Civil_and_Environmental_Engineering": 105,
+    "Comparative_Media_Studies_Writing": 71,
+    "Concourse": 5,
+    "Earth,_Atmospheric,_and_Planetary_Sciences": 111,
+    "Economics": 85,
+    "Edgerton_Center": 28,
+    "Electrical_Engineering_and_Computer_Science": 298,
+    "Engineering_Systems_Division": 66,
+    "Experimental_Study_Group": 30,
+    "Global_Studies_and_Languages": 121,
+    "Health_Sciences_and_Technology": 72,
+    "History": 91,
+    "Institute_for_Data,_Systems,_and_Society": 20,
+    "Linguistics_and_Philosophy": 85,
+    "Literature": 128,
+    "Materials_Science_and_Engineering": 92,
+    "Mathematics": 213,
+    "Mechanical_Engineering": 162,
+    "Media_Arts_and_Sciences": 47,
+    "Music_and_Theater_Arts": 69,
+    "Nuclear_Science_and_Engineering": 53,
+    "Others": 447,
+    "Physics": 117,
+    "Political_Science": 97,
+    "Science,_Technology_and_Society": 70,
+    "Sloan_School_of_Management": 218,
+    "Special_Programs": 2,
+    "Urban_Studies_and_Planning": 211,
+    "Women's_and_Gender_Studies": 61
+})
+
+_AVAILABLE_DEPARTMENT_NAMES = frozenset(_AVAILABLE_DEPARTMENTS)
+
+_DEPARTMENTS_PROMPT_BLOCK = "\n".join(
+    [f"- {dept}: {count} courses" for dept, count in _AVAILABLE_DEPARTMENTS.items()])
+
+# Student-independent part of the department selection prompt, sent first so it can be served
+# from Claude's prompt cache
+_DEPARTMENT_SELECTION_INSTRUCTIONS = f"""You are an expert academic advisor analyzing student profiles to recommend university departments from MIT.
+
+AVAILABLE DEPARTMENTS:
+{_DEPARTMENTS_PROMPT_BLOCK}
+
+CRITICAL SELECTION RULES:
+1. Select 1-3 departments maximum (only high-confidence matches)
+2. Quality over quantity - don't force 3 if fewer are appropriate
+3. MANDATORY: If student has low/beginner STEM skills but wants STEM field, MUST include foundational departments:
+   - Mathematics (for mathematical foundations)
+   - Physics (for science foundations) 
+   - Electrical_Engineering_and_Computer_Science (for programming/engineering foundations)
+4. Consider student's interests, current skill level, and learning goals
+5. Only select departments you're highly confident will benefit the student
+
+RESPONSE FORMAT:
+Return ONLY a JSON array of department names, for example:
+["Mathematics", "Physics", "Electrical_Engineering_and_Computer_Science"]"""
+
+
+@functools.lru_cache(maxsize=64)
+def _read_department_courses(department: str) -> List[Dict]:
+    """Parse a department JSON file once and share it, so don't mutate it. Errors propagate and are not cached."""
+    with open(f"{DEPARTMENTS_DIR}/{department}.json", 'rb') as f:
+        return _json_loads(f.read())
+
+
+def _load_department_courses(department: str) -> List[Dict]:
+    """Load courses from department JSON file."""
+    try:
+        return _read_department_courses(department)
+    except FileNotFoundError:
+        logger.warning(f"Department file not found: {DEPARTMENTS_DIR}/{department}.json")
+        return []
+    except Exception as e:
+        logger.error(f"Error loading department {department}: {str(e)}")
+        return []
+
+
+@functools.lru_cache(maxsize=64)
+def _department_courses_text(department: str) -> str:
+    """Course list (title and short description) for a department, as sent in the course selection prompt."""
+    return "\n".join([
+        f"- {course.get('title', 'No Title')}: {course.get('short_description', 'No Description')}"
+        for course in _read_department_courses(department)[:50]  # Limit to avoid token limits
+    ])
+
+
+@functools.lru_cache(maxsize=64)
+def _department_instructions(department: str) -> str:
+    """Student-independent part of the course selection prompt: the department catalog and selection rules."""
+    return _COURSE_SELECT_TMPL.substitute(department=department, courses=_department_courses_text(department))
+
+
+# Claude responses that parsed successfully, keyed by a digest of (model, prompt). Module-level so that
+# generate_course_roadmap, which builds a new recommender per call, still gets hits.
+_RESPONSE_CACHE: Dict[bytes, str] = {}
+_RESPONSE_CACHE_SIZE = 256
+
+
+def _format_skills(skill_levels: List[List[str]]) -> str:
+    """Render [skill_name, skill_level] pairs as the prompt's skills list."""
+    return "\n".join(f"- {skill[0]}: {skill[1]}" for skill in skill_levels)
+
+
+def _cached_prompt(static_text: str, dynamic_text: str) -> List[Dict]:
+    """
+    Message content with the static text marked for Claude's prompt caching.
+
+    The cached block has to be the prompt prefix, so the request-specific text always comes last.
+    """
+    return [
+        {"type": "text", "text": static_text, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": dynamic_text},
+    ]
+
+
+def _response_cache_key(model: str, prompt: Union[str, List[Dict]]) -> bytes:
+    """Content-addressed key for a prompt, either a string or a list of text content blocks."""
+    if not isinstance(prompt, str):
+        prompt = "\0".join(block["text"] for block in prompt)
+    return hashlib.blake2b(f"{model}\0{prompt}".encode('utf-8'), digest_size=16).digest()
+
+
+def _store_response(key: bytes, response: str) -> None:
+    """Remember a response, evicting the oldest entry once the cache is full."""
+    if len(_RESPONSE_CACHE) >= _RESPONSE_CACHE_SIZE:
+        _RESPONSE_CACHE.pop(next(iter(_RESPONSE_CACHE)), None)
+    _RESPONSE_CACHE[key] = response
+
+
+# Below this many courses the pure-Python pass beats the cost of building CSR arrays
+_NUMBA_MIN_COURSES = 500
+
+
+def _strongly_connected_components(nodes: List[str], successors: Dict[str, List[str]]) -> Dict[str, int]:
+    """Tarjan's algorithm, iterative so long prerequisite chains can't hit the recursion limit."""
+    index: Dict[str, int] = {}
+    low: Dict[str, int] = {}
+    component: Dict[str, int] = {}
+    stack: List[str] = []
+    on_stack = set()
+    component_count = 0
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors[root]))]
+        while work:
+            node, pending = work[-1]
+            for successor in pending:
+                if successor not in index:
+                    index[successor] = low[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(successors[successor])))
+                    break
+                if successor in on_stack:
+                    low[node] = min(low[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component[member] = component_count
+                        if member == node:
+                            break
+                    component_count += 1
+    return component
+
+
+def _level_leftover_courses(levels: Dict[str, int], leftover: List[str], edges: List[List[str]]) -> None:
+    """
+    Level the courses Kahn's pass never released: members of prerequisite cycles and everything
+    downstream of them.
+
+    Each cycle is levelled as one unit placed after every other level, and the leftover graph
+    with cycles collapsed is a DAG, so levels are relaxed over it again. Courses that merely
+    depend on a cycle therefore still come after it, and after all of their prerequisites.
+    """
+    remaining = set(leftover)
+    successors: Dict[str, List[str]] = {name: [] for name in leftover}
+    self_loops = set()
+    for prereq, course in edges:
+        if prereq in remaining and course in remaining:
+            successors[prereq].append(course)
+            if prereq == course:
+                self_loops.add(prereq)
+
+    component = _strongly_connected_components(leftover, successors)
+    members: Dict[int, List[str]] = {}
+    for name in leftover:
+        members.setdefault(component[name], []).append(name)
+    cyclic = {cid for cid, names in members.items() if len(names) > 1 or names[0] in self_loops}
+    logger.warning(f"Prerequisite cycle detected among: {[name for cid in cyclic for name in members[cid]]}")
+
+    # Levels already hold the contribution of every released prerequisite
+    cycle_level = max(levels.values()) + 1
+    component_levels = {cid: cycle_level if cid in cyclic else levels[names[0]] for cid, names in members.items()}
+    component_successors: Dict[int, List[int]] = {cid: [] for cid in members}
+    in_degree = dict.fromkeys(members, 0)
+    for name in leftover:
+        for successor in successors[name]:
+            if component[name] != component[successor]:
+                component_successors[component[name]].append(component[successor])
+                in_degree[component[successor]] += 1
+
+    queue = deque(cid for cid, degree in in_degree.items() if degree == 0)
+    while queue:
+        cid = queue.popleft()
+        for successor in component_successors[cid]:
+            component_levels[successor] = max(component_levels[successor], component_levels[cid] + 1)
+            in_degree[successor] -= 1
+            if in_degree[successor] == 0:
+                queue.append(successor)
+
+    for name in leftover:
+        levels[name] = component_levels[component[name]]
+
+
+def _kahn_levels_kernel(indptr, indices, in_degree, levels, queue):
+    """
+    Kahn's algorithm over a CSR adjacency, compiled with Numba by _compiled_kahn_kernel.
+
+    Fills levels (zeroed) and uses queue as scratch space, both of length n; decrements in_degree
+    in place and returns how many courses were visited.
+    """
+    n = in_degree.shape[0]
+    head = 0
+    tail = 0
+    for node in range(n):
+        if in_degree[node] == 0:
+            queue[tail] = node
+            tail += 1
+    while head < tail:
+        node = queue[head]
+        head += 1
+        for k in range(indptr[node], indptr[node + 1]):
+            dependent = indices[k]
+            if levels[node] + 1 > levels[dependent]:
+                levels[dependent] = levels[node] + 1
+            in_degree[dependent] -= 1
+            if in_degree[dependent] == 0:
+                queue[tail] = dependent
+                tail += 1
+    return tail
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_kahn_kernel():
+    """
+    The Numba-compiled kernel, or None when numba/numpy aren't installed.
+
+    Imported on first use rather than with the module: numba alone adds ~150 ms to startup,
+    and only graphs of _NUMBA_MIN_COURSES or more need it.
+    """
+    try:
+        from numba import njit
+    except Exception:
+        return None
+    return njit(cache=True)(_kahn_levels_kernel)
+
+
+def _topological_levels_numba(kernel, course_names: List[str], edges: List[List[str]]) -> Dict[str, int]:
+    """_topological_levels on integer-indexed CSR arrays, run by the compiled kernel."""
+    import numpy as np
+
+    names = list(dict.fromkeys(course_names))
+    index = {name: i for i, name in enumerate(names)}
+    n = len(names)
+
+    sources = np.fromiter((index[prereq] for prereq, _ in edges), np.int32, len(edges))
+    targets = np.fromiter((index[course] for _, course in edges), np.int32, len(edges))
+    indices = targets[np.argsort(sources, kind='stable')]
+    indptr = np.zeros(n + 1, np.int32)
+    indptr[1:] = np.cumsum(np.bincount(sources, minlength=n))
+    in_degree = np.bincount(targets, minlength=n).astype(np.int32)
+
+    levels_array = np.zeros(n, np.int32)
+    visited = kernel(indptr, indices, in_degree, levels_array, np.empty(n, np.int32))
+    levels = dict(zip(names, levels_array.tolist()))
+    if visited < n:
+        _level_leftover_courses(levels, [names[i] for i in np.flatnonzero(in_degree > 0)], edges)
+    return levels
+
+
+def _topological_levels(course_names: List[str], edges: List[List[str]]) -> Dict[str, int]:
+    """
+    Kahn's algorithm over [prerequisite, dependent] edges.
+
+    Returns the level of every course: 0 for courses without prerequisites, otherwise one more
+    than its deepest prerequisite. Courses in a prerequisite cycle share a level after every
+    other acyclic course; courses depending on a cycle come after it. Large graphs go through the Numba kernel when it is installed.
+    """
+    if len(course_names) >= _NUMBA_MIN_COURSES:
+        kernel = _compiled_kahn_kernel()
+        if kernel is not None:
+            return _topological_levels_numba(kernel, course_names, edges)
+
+    dependents: Dict[str, List[str]] = {name: [] for name in course_names}
+    in_degree = dict.fromkeys(course_names, 0)
+    for prereq, course in edges:
+        dependents[prereq].append(course)
+        in_degree[course] += 1
+
+    levels = dict.fromkeys(course_names, 0)
+    # Iterate the deduplicated keys: a course listed twice must only be dequeued once
+    queue = deque(name for name, degree in in_degree.items() if degree == 0)
+    visited = 0
+    while queue:
+        name = queue.popleft()
+        visited += 1
+        for dependent in dependents[name]:
+            levels[dependent] = max(levels[dependent], levels[name] + 1)
+            in_degree[dependent] -= 1
+            if in_degree[dependent] == 0:
+                queue.append(dependent)
+
+    if visited < len(levels):
+        _level_leftover_courses(levels, [name for name, degree in in_degree.items() if degree > 0], edges)
+    return levels
+
+
+_MAX_BACKOFF_SECONDS = 30.0
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before retrying: the server's retry-after on rate limits, else jittered exponential backoff."""
+    if isinstance(error, anthropic.RateLimitError):
+        retry_after = error.response.headers.get('retry-after')
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                delay = math.nan
+            # Clamp so a bogus or huge header can neither crash the sleep nor stall the request
+            if math.isfinite(delay):
+                return max(0.0, min(delay, _MAX_BACKOFF_SECONDS))
+    # Jitter keeps concurrent requests from retrying in lockstep
+    return min(2 ** attempt + random.uniform(0, 1), _MAX_BACKOFF_SECONDS)
+
+
+def _is_server_error(error: Exception) -> bool:
+    """Whether the API answered with a 5xx status."""
+    return isinstance(error, anthropic.APIStatusError) and error.status_code >= 500
+
+
+def _next_retry_delay(error: Exception, attempt: int, max_retries: int,
+                      server_errors: int) -> Tuple[Optional[float], int]:
+    """
+    Log a failed API attempt and decide whether to retry.
+
+    Returns the delay before the next attempt (None to give up) and the updated count of
+    consecutive 5xx responses.
+    """
+    logger.warning(f"API call attempt {attempt + 1} failed: {str(error)}")
+    # Stop early after two 5xx responses in a row, the service is unlikely to recover in time
+    server_errors = server_errors + 1 if _is_server_error(error) else 0
+    if attempt < max_retries - 1 and server_errors < 2:
+        return _retry_delay(error, attempt), server_errors
+    logger.error(f"All API call attempts failed: {str(error)}")
+    return None, server_errors
+
 
 class CourseRecommendationSystem:
     def __init__(self, api_key: str):
         """Initialize the course recommendation system with Claude API key."""
-        self.client = anthropic.Anthropic(api_key=api_key)
+        self.api_key = api_key
+        # The SDK's own retries are disabled: _next_retry_delay is the only retry policy
+        self.client = anthropic.Anthropic(api_key=api_key, max_retries=0)
         self.model = "claude-sonnet-4-20250514"
 
         # Available departments with course counts
-        self.available_departments = {
-            "Aeronautics_and_Astronautics": 92,
-            "Anthropology": 67,
-            "Architecture": 116,
-            "Athletics,_Physical_Education_and_Recreation": 10,
-            "Biological_Engineering": 41,
-            "Biology": 85,
-            "Brain_and_Cognitive_Sciences": 99,
-            "Chemical_Engineering": 57,
-            "Chemistry": 43,
-            "Civil_and_Environmental_Engineering": 105,
-            "Comparative_Media_Studies_Writing": 71,
-            "Concourse": 5,
-            "Earth,_Atmospheric,_and_Planetary_Sciences": 111,
-            "Economics": 85,
-            "Edgerton_Center": 28,
-            "Electrical_Engineering_and_Computer_Science": 298,
-            "Engineering_Systems_Division": 66,
-            "Experimental_Study_Group": 30,
-            "Global_Studies_and_Languages": 121,
-            "Health_Sciences_and_Technology": 72,
-            "History": 91,
-            "Institute_for_Data,_Systems,_and_Society": 20,
-            "Linguistics_and_Philosophy": 85,
-            "Literature": 128,
-            "Materials_Science_and_Engineering": 92,
-            "Mathematics": 213,
-            "Mechanical_Engineering": 162,
-            "Media_Arts_and_Sciences": 47,
-            "Music_and_Theater_Arts": 69,
-            "Nuclear_Science_and_Engineering": 53,
-            "Others": 447,
-            "Physics": 117,
-            "Political_Science": 97,
-            "Science,_Technology_and_Society": 70,
-            "Sloan_School_of_Management": 218,
-            "Special_Programs": 2,
-            "Urban_Studies_and_Planning": 211,
-            "Women's_and_Gender_Studies": 61
+        self.available_departments = _AVAILABLE_DEPARTMENTS
+
+    def _message_params(self, prompt: Union[str, List[Dict]]) -> Dict[str, Any]:
+        """Request parameters shared by the sync and async API calls."""
+        return {
+            "model": self.model,
+            "max_tokens": 4000,
+            "temperature": 0.1,
+            "messages": [{"role": "user", "content": prompt}],
         }
 
-    def _call_claude_api(self, prompt: str, max_retries: int = 3) -> Optional[str]:
-        """Make API call to Claude with retry logic and error handling."""
+    def _cached_response(self, prompt: Union[str, List[Dict]]) -> Optional[str]:
+        """A previously parsed response to this exact prompt, if any."""
+        return _RESPONSE_CACHE.get(_response_cache_key(self.model, prompt))
+
+    def _remember_response(self, prompt: Union[str, List[Dict]], response: str) -> None:
+        """Cache a response once its caller has parsed it, so unusable replies are never replayed."""
+        _store_response(_response_cache_key(self.model, prompt), response)
+
+    def _call_claude_api(self, prompt: Union[str, List[Dict]], max_retries: int = 3) -> Optional[str]:
+        """Make API call to Claude with retry logic and error handling. Identical prompts are served from cache."""
+        cached = self._cached_response(prompt)
+        if cached is not None:
+            return cached
+
+        server_errors = 0
         for attempt in range(max_retries):
             try:
-                message = self.client.messages.create(
-                    model=self.model,
-                    max_tokens=4000,
-                    temperature=0.1,
-                    messages=[{"role": "user", "content": prompt}]
-                )
+                message = self.client.messages.create(**self._message_params(prompt))
                 return message.content[0].text
             except Exception as e:
-                logger.warning(f"API call attempt {attempt + 1} failed: {str(e)}")
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)  # Exponential backoff
-                else:
-                    logger.error(f"All API call attempts failed: {str(e)}")
+                delay, server_errors = _next_retry_delay(e, attempt, max_retries, server_errors)
+                if delay is None:
                     return None
+                time.sleep(delay)
         return None
 
+    async def _acall_claude_api(self, aclient: "anthropic.AsyncAnthropic", prompt: Union[str, List[Dict]],
+                                max_retries: int = 3) -> Optional[str]:
+        """Async counterpart of _call_claude_api, used to fan out calls on one event loop."""
+        cached = self._cached_response(prompt)
+        if cached is not None:
+            return cached
+
+        server_errors = 0
+        for attempt in range(max_retries):
+            try:
+                message = await aclient.messages.create(**self._message_params(prompt))
+                return message.content[0].text
+            except Exception as e:
+                delay, server_errors = _next_retry_delay(e, attempt, max_retries, server_errors)
+                if delay is None:
+                    return None
+                await asyncio.sleep(delay)
+        return None
+
+    async def _agather_responses(self, prompts: List[List[Dict]]) -> List[Optional[str]]:
+        """Issue all prompts at once on the running loop."""
+        if not prompts:
+            return []
+        # The async client's connection pool is bound to the loop it was opened on, so it lives
+        # only as long as this coroutine
+        async with anthropic.AsyncAnthropic(api_key=self.api_key, max_retries=0) as aclient:
+            return await asyncio.gather(*[self._acall_claude_api(aclient, prompt) for prompt in prompts])
+
     def select_departments(self, advisor_description: str, conversation_transcript: str,
                            skill_levels: List[List[str]]) -> List[str]:
         """
@@ -91,16 +599,9 @@ class CourseRecommendationSystem:
         Returns:
             List of selected department names (1-3 departments)
         """
-        # Format skill levels for the prompt
-        skills_text = "\n".join([f"- {skill[0]}: {skill[1]}" for skill in skill_levels])
-
-        # Create departments list for prompt
-        departments_text = "\n".join(
-            [f"- {dept}: {count} courses" for dept, count in self.available_departments.items()])
-
-        prompt = f"""You are an expert academic advisor analyzing student profiles to recommend university departments from MIT.
+        skills_text = _format_skills(skill_levels)
 
-STUDENT PROFILE:
+        student_profile = f"""STUDENT PROFILE:
 Advisor Assessment: {advisor_description}
 
 Conversation Context: {conversation_transcript}
@@ -108,37 +609,24 @@ Conversation Context: {conversation_transcript}
 Current Skills and Levels:
 {skills_text}
 
-AVAILABLE DEPARTMENTS:
-{departments_text}
-
-CRITICAL SELECTION RULES:
-1. Select 1-3 departments maximum (only high-confidence matches)
-2. Quality over quantity - don't force 3 if fewer are appropriate
-3. MANDATORY: If student has low/beginner STEM skills but wants STEM field, MUST include foundational departments:
-   - Mathematics (for mathematical foundations)
-   - Physics (for science foundations) 
-   - Electrical_Engineering_and_Computer_Science (for programming/engineering foundations)
-4. Consider student's interests, current skill level, and learning goals
-5. Only select departments you're highly confident will benefit the student
-
-RESPONSE FORMAT:
-Return ONLY a JSON array of department names, for example:
-["Mathematics", "Physics", "Electrical_Engineering_and_Computer_Science"]
-
 Analyze the student profile and select the most appropriate departments."""
 
+        prompt = _cached_prompt(_DEPARTMENT_SELECTION_INSTRUCTIONS, student_profile)
+
         try:
             response = self._call_claude_api(prompt)
             if response:
                 # Extract JSON from response
-                import re
-                json_match = re.search(r'\[.*?\]', response, re.DOTALL)
+                json_match = _JSON_ARRAY_RE.search(response)
                 if json_match:
-                    departments = json.loads(json_match.group())
-                    # Validate departments exist
-                    valid_departments = [dept for dept in departments if dept in self.available_departments]
+                    departments = _decode_departments(json_match.group())
+                    # Validate departments exist, drop repeats (keeping Claude's order) and cap at 3
+                    valid_departments = list(dict.fromkeys(
+                        dept for dept in departments if dept in _AVAILABLE_DEPARTMENT_NAMES))[:3]
                     logger.info(f"Selected departments: {valid_departments}")
-                    return valid_departments[:3]  # Ensure max 3 departments
+                    if valid_departments:
+                        self._remember_response(prompt, response)
+                    return valid_departments
 
             logger.error("Failed to parse department selection from Claude response")
             return []
@@ -147,26 +635,107 @@ Analyze the student profile and select the most appropriate departments."""
             logger.error(f"Error in select_departments: {str(e)}")
             return []
 
-    def _load_department_courses(self, department: str) -> List[Dict]:
-        """Load courses from department JSON file."""
+    def _build_department_prompt(self, department: str, advisor_description: str,
+                                 conversation_transcript: str, skills_text: str) -> List[Dict]:
+        """Build the course selection prompt for a single department."""
+        student_profile = _COURSE_SELECT_STUDENT_TMPL.substitute(
+            advisor=advisor_description, transcript=conversation_transcript, skills=skills_text)
+        return _cached_prompt(_department_instructions(department), student_profile)
+
+    def _parse_department_response(self, department: str, response: Optional[str],
+                                   department_courses: List[Dict]) -> List[Dict]:
+        """Extract the selected courses from Claude's response for a single department."""
         try:
-            file_path = f"departments/{department}.json"
-            if os.path.exists(file_path):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    courses = json.load(f)
-                    return courses
-            else:
-                logger.warning(f"Department file not found: {file_path}")
-                return []
+            if response:
+                # Find the complete JSON array, ignoring brackets inside strings
+                json_str = _extract_json_array(response)
+                if json_str is not None:
+                    # Clean the JSON string
+                    json_str = json_str.replace('\n', ' ').replace('\r', ' ')
+                    json_str = _WHITESPACE_RE.sub(' ', json_str)  # Multiple spaces to single
+
+                    try:
+                        courses = _decode_courses(json_str)
+                        if isinstance(courses, list):
+                            # Enrich courses with original descriptions from department_courses
+                            for course in courses:
+                                course_title = course.get('course_title', '')
+                                # Find original course in department_courses
+                                for original_course in department_courses:
+                                    if original_course.get('title', '') == course_title:
+                                        course['original_description'] = original_course.get(
+                                            'short_description', 'No description')
+                                        break
+
+                            logger.info(f"Selected {len(courses)} courses from {department}")
+                            return courses
+                        else:
+                            logger.error(f"Invalid JSON structure from {department}")
+                    except ValueError as je:  # json, orjson and msgspec decode errors are all ValueErrors
+                        logger.error(f"JSON decode error for {department}: {str(je)}")
+                        logger.error(f"Problematic JSON: {json_str}")
+                else:
+                    logger.error(f"No JSON array found in response for {department}")
+                    logger.error(f"Full response: {response}")
+
         except Exception as e:
-            logger.error(f"Error loading department {department}: {str(e)}")
-            return []
+            logger.error(f"Error selecting courses from {department}: {str(e)}")
+
+        return []
+
+    def _department_jobs(self, selected_departments: List[str], advisor_description: str,
+                         conversation_transcript: str,
+                         skill_levels: List[List[str]]) -> List[Tuple[str, List[Dict], List[Dict]]]:
+        """(department, department_courses, prompt) for every selected department that has courses."""
+        # Formatted once and shared by every department's prompt
+        skills_text = _format_skills(skill_levels)
+
+        jobs = []
+        for department in selected_departments:
+            # Load courses from department
+            department_courses = _load_department_courses(department)
+            if not department_courses:
+                continue
+            prompt = self._build_department_prompt(department, advisor_description,
+                                                   conversation_transcript, skills_text)
+            jobs.append((department, department_courses, prompt))
+        return jobs
+
+    def _collect_department_courses(self, jobs: List[Tuple[str, List[Dict], List[Dict]]],
+                                    responses: List[Optional[str]]) -> List[Dict]:
+        """Parse every department's response, in department order."""
+        all_selected_courses = []
+        for (department, department_courses, prompt), response in zip(jobs, responses):
+            courses = self._parse_department_response(department, response, department_courses)
+            if courses:
+                self._remember_response(prompt, response)
+            all_selected_courses.extend(courses)
+
+        logger.info(f"Total selected courses with prerequisites: {len(all_selected_courses)}")
+        return all_selected_courses
+
+    async def aselect_courses_with_prerequisites(self, selected_departments: List[str], advisor_description: str,
+                                                 conversation_transcript: str,
+                                                 skill_levels: List[List[str]]) -> List[Dict]:
+        """
+        Async version of select_courses_with_prerequisites.
+
+        Departments are independent, so all of their Claude calls are issued at once with asyncio.gather.
+        """
+        jobs = self._department_jobs(selected_departments, advisor_description, conversation_transcript,
+                                     skill_levels)
+        responses = await self._agather_responses([prompt for _, _, prompt in jobs])
+        return self._collect_department_courses(jobs, responses)
 
     def select_courses_with_prerequisites(self, selected_departments: List[str], advisor_description: str,
                                           conversation_transcript: str, skill_levels: List[List[str]]) -> List[Dict]:
         """
         Function 2: Select specific courses from chosen departments and identify prerequisites.
 
+        Department calls run concurrently: on a fresh event loop when none is running, otherwise
+        (e.g. called from an async web handler or a notebook) on a thread pool. Async callers can
+        await aselect_courses_with_prerequisites instead.
+
         Args:
             selected_departments: Output from select_departments function
             advisor_description: Same as Function 1
@@ -176,130 +745,20 @@ Analyze the student profile and select the most appropriate departments."""
         Returns:
             List of course objects with prerequisites
         """
-        all_selected_courses = []
-
-        # Format skill levels for prompt
-        skills_text = "\n".join([f"- {skill[0]}: {skill[1]}" for skill in skill_levels])
-
-        for department in selected_departments:
-            # Load courses from department
-            department_courses = self._load_department_courses(department)
-            if not department_courses:
-                continue
-
-            # Prepare course list for Claude (title and short description)
-            courses_text = "\n".join([
-                f"- {course.get('title', 'No Title')}: {course.get('short_description', 'No Description')}"
-                for course in department_courses[:50]  # Limit to avoid token limits
-            ])
-
-            prompt = f"""You are selecting specific courses from {department} department for a student based on their profile.
-
-            STUDENT PROFILE:
-            Advisor Assessment: {advisor_description}
-
-            Conversation Context: {conversation_transcript}
-
-            Current Skills and Levels:
-            {skills_text}
-
-            AVAILABLE COURSES IN {department}:
-            {courses_text}
-
-            SELECTION REQUIREMENTS:
-            1. Select courses that closely match student interests and goals
-            2. Consider skill level for difficulty appropriateness
-            3. For each selected course, identify ALL necessary prerequisites based on student's current skill level
-            4. CRITICAL: Prerequisites must be ACTUAL course titles from the available courses, not generic names
-            5. Prerequisite Logic:
-               - Beginner STEM students: Include foundational courses (Precalculus, Calculus, Basic Physics, etc.)
-               - Intermediate students: Some foundational courses, can skip very basics
-               - Advanced students: Direct access to advanced courses with minimal prerequisites
-            6. Only select courses you're confident will benefit this specific student
-            7. Quality over quantity - better to select fewer, more relevant courses
-
-            RESPONSE FORMAT:
-Return ONLY a valid JSON array. CRITICAL JSON RULES:
-- NO line breaks anywhere in the JSON
-- NO quotes inside descriptions 
-- Keep descriptions under 500 characters
-- Use simple punctuation only (periods, commas)
-- Select as many courses per department as needed. Do not histate to add as many prerequisites as need. Add many and be happy. I need from you the comprehending guide for the user. With the full list of courses.
-
-RESPONSE FORMAT:
-            Return ONLY a valid JSON array. CRITICAL JSON RULES:
-            - NO line breaks anywhere in the JSON
-            - NO quotes inside descriptions 
-            - Keep descriptions under 50 characters
-            - Use simple punctuation only (periods, commas)
-            - Select as many courses per department as needed
-
-            Return format: JSON array of course objects with course_title, course_description, department, and prerequisites fields.
-
-            IMPORTANT: Return ONLY the JSON array, nothing else. No explanations.
-
-            Select appropriate courses with complete prerequisite chains for this student."""
-
-            try:
-                response = self._call_claude_api(prompt)
-                if response:
-                    import re
-
-                    # Find the complete JSON array using bracket counting
-                    start_idx = response.find('[')
-                    if start_idx != -1:
-                        bracket_count = 0
-                        end_idx = start_idx
-
-                        for i, char in enumerate(response[start_idx:], start_idx):
-                            if char == '[':
-                                bracket_count += 1
-                            elif char == ']':
-                                bracket_count -= 1
-                                if bracket_count == 0:
-                                    end_idx = i + 1
-                                    break
-
-                        json_str = response[start_idx:end_idx]
-
-                        # Clean the JSON string
-                        json_str = json_str.replace('\n', ' ').replace('\r', ' ')
-                        json_str = re.sub(r'\s+', ' ', json_str)  # Multiple spaces to single
-
-                        try:
-                            courses = json.loads(json_str)
-                            if isinstance(courses, list):
-                                all_selected_courses.extend(courses)
-                                logger.info(f"Selected {len(courses)} courses from {department}")
-                                if isinstance(courses, list):
-                                    # Enrich courses with original descriptions from department_courses
-                                    for course in courses:
-                                        course_title = course.get('course_title', '')
-                                        # Find original course in department_courses
-                                        for original_course in department_courses:
-                                            if original_course.get('title', '') == course_title:
-                                                course['original_description'] = original_course.get(
-                                                    'short_description', 'No description')
-                                                break
-
-                                    all_selected_courses.extend(courses)
-                                    logger.info(f"Selected {len(courses)} courses from {department}")
-                            else:
-                                logger.error(f"Invalid JSON structure from {department}")
-                        except json.JSONDecodeError as je:
-                            logger.error(f"JSON decode error for {department}: {str(je)}")
-                            logger.error(f"Problematic JSON: {json_str}")
-                    else:
-                        logger.error(f"No JSON array found in response for {department}")
-                        logger.error(f"Full response: {response}")
-
-            except Exception as e:
-                logger.error(f"Error selecting courses from {department}: {str(e)}")
+        jobs = self._department_jobs(selected_departments, advisor_description, conversation_transcript,
+                                     skill_levels)
+        prompts = [prompt for _, _, prompt in jobs]
 
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            responses = asyncio.run(self._agather_responses(prompts))
+        else:
+            # asyncio.run can't nest inside a running loop
+            with ThreadPoolExecutor(max_workers=max(len(prompts), 1)) as executor:
+                responses = list(executor.map(self._call_claude_api, prompts))
 
-
-        logger.info(f"Total selected courses with prerequisites: {len(all_selected_courses)}")
-        return all_selected_courses
+        return self._collect_department_courses(jobs, responses)
 
     def create_learning_roadmap(self, courses_with_prereqs: List[Dict], student_profile: Dict = None) -> List:
         """
@@ -311,7 +770,7 @@ RESPONSE FORMAT:
 
         Returns:
             List in format: [[vertices], [edges]]
-            vertices: List of [course_name, original_course_description] pairs
+            vertices: List of [course_name, original_course_description] pairs, in prerequisite order
             edges: List of [prerequisite_course, dependent_course] pairs
         """
         if not courses_with_prereqs:
@@ -365,6 +824,10 @@ RESPONSE FORMAT:
                 # Edge format: [prerequisite_course, dependent_course]
                 edges.append([prereq, course_name])
 
+        # Order vertices so every course comes after its prerequisites (stable within a level)
+        levels = _topological_levels([vertex[0] for vertex in vertices], edges)
+        vertices.sort(key=lambda vertex: levels[vertex[0]])
+
         logger.info(f"Created graph with {len(vertices)} vertices and {len(edges)} edges")
         return [vertices, edges]
 